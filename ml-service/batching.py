@@ -0,0 +1,77 @@
+"""
+Dynamic micro-batching for TimesFM inference.
+
+Concurrent single predictions are coalesced into one model.forecast call
+so the torch-compiled graph sees real batches instead of batch size 1.
+Callers submit (price_array, horizon) items and block on a Future; a
+background thread drains up to max_batch items (or until max_wait_ms
+elapses), groups them by shape and horizon, and runs one forward pass
+per group, distributing each item's row back to its caller.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class BatchScheduler:
+    """Coalesces concurrent forecast requests into batched forward passes."""
+
+    def __init__(self, infer_fn, max_batch=16, max_wait_ms=5):
+        self._infer_fn = infer_fn
+        self._max_batch = max_batch
+        self._max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name='batch-scheduler', daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, price_array, horizon):
+        """Enqueue one input and return a Future resolving to the item's
+        (point_forecast, quantile_forecast) arrays."""
+        future = Future()
+        self._queue.put((price_array, horizon, future))
+        return future
+
+    def _drain(self):
+        """Block for the first item, then collect more until the batch is
+        full or max_wait_ms has elapsed."""
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self._max_wait
+        while len(items) < self._max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while True:
+            items = self._drain()
+            # Group by (input length, horizon) so every forward pass sees
+            # one static shape and hits one pre-bound horizon forecaster;
+            # inputs are already padded to fixed bucket sizes.
+            groups = {}
+            for item in items:
+                groups.setdefault((len(item[0]), item[1]), []).append(item)
+            for (_, horizon), group in groups.items():
+                self._infer_group(horizon, group)
+
+    def _infer_group(self, horizon, items):
+        arrays = [item[0] for item in items]
+        futures = [item[2] for item in items]
+
+        try:
+            points, quantiles = self._infer_fn(horizon, arrays)
+        except Exception as exc:
+            for future in futures:
+                future.set_exception(exc)
+            return
+
+        for i, future in enumerate(futures):
+            future.set_result((points[i], quantiles[i]))
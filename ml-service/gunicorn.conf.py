@@ -0,0 +1,36 @@
+"""
+gunicorn configuration for the ML service.
+
+Each worker is a uvicorn event loop (uvloop + httptools) hosting the
+Quart app, so network I/O and JSON decode/encode for other requests
+overlap the current forward pass; actual inference is serialized by
+_INFER_LOCK in server.py.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5001')}"
+workers = int(os.environ.get('GUNICORN_WORKERS', '1'))
+worker_class = 'uvicorn.workers.UvicornWorker'
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+
+# With ML_SHARE_MODEL=1 the master loads the model once before forking
+# and moves the weights into shared memory, so N workers share a single
+# copy and a single torch.compile run. CPU-only: CUDA contexts do not
+# survive fork, so GPU deployments keep per-worker loading.
+preload_app = os.environ.get('ML_SHARE_MODEL', '0') == '1'
+
+if preload_app:
+    from server import load_model
+    load_model(share=True)
+
+
+def post_fork(server, worker):
+    """Initialize each worker after the fork: load the model unless the
+    master preloaded it, then build the per-process inference state
+    (batch scheduler thread, CUDA buffers) — threads never survive the
+    fork, so that state can only be created here."""
+    from server import init_worker, load_model
+    if not preload_app:
+        load_model()
+    init_worker()
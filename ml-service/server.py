@@ -0,0 +1,609 @@
+"""
+Spectra ML Service
+
+TimesFM 2.5 (200M) price forecasting service consumed by the Node.js
+backend (see backend/src/ml/MLInferenceService.ts). Exposes /health,
+/predict and /batch-predict on port 5001.
+
+Served as an ASGI app (Quart) under gunicorn's uvicorn worker class:
+
+    gunicorn -c gunicorn.conf.py server:app
+
+GUNICORN_WORKERS controls the worker count; each worker runs a uvloop
+event loop, so HTTP I/O for many concurrent connections proceeds while
+handlers await inference futures from the batch scheduler. The model is
+loaded once per worker from the post_fork hook in gunicorn.conf.py, and
+inference itself is serialized behind _INFER_LOCK.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+
+# Point Inductor at a persistent on-disk cache so restarts reuse
+# compiled artifacts instead of paying the full Dynamo/Inductor cost
+# again; in containers, mount a volume at this path so it survives
+# redeploys. Must be configured before torch is first imported.
+if 'TORCHINDUCTOR_CACHE_DIR' not in os.environ:
+    _INDUCTOR_CACHE = os.environ.get(
+        'TIMESFM_CACHE_DIR', '/var/cache/timesfm_inductor'
+    )
+    try:
+        os.makedirs(_INDUCTOR_CACHE, exist_ok=True)
+    except OSError:
+        _INDUCTOR_CACHE = os.path.expanduser('~/.cache/timesfm_inductor')
+        os.makedirs(_INDUCTOR_CACHE, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = _INDUCTOR_CACHE
+os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+
+import numpy as np
+import orjson
+import torch
+from cachetools import TTLCache
+from quart import Quart, request
+
+from batching import BatchScheduler
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('ml-service')
+
+app = Quart(__name__)
+
+# The only caller is the trusted Node backend, so CORS is a fixed set of
+# headers stamped on every response — no per-request origin
+# introspection middleware on the hot path.
+_CORS_ORIGIN = os.environ.get('ML_CORS_ORIGIN', '*')
+
+
+@app.after_request
+async def _cors(response):
+    response.headers['Access-Control-Allow-Origin'] = _CORS_ORIGIN
+    response.headers['Access-Control-Allow-Methods'] = 'POST,GET,OPTIONS'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+    return response
+
+
+@app.route('/', defaults={'_path': ''}, methods=['OPTIONS'])
+@app.route('/<path:_path>', methods=['OPTIONS'])
+async def _preflight(_path):
+    return '', 204
+
+MODEL_VERSION = 'timesfm-2.5-200m'
+VALID_HORIZONS = (1, 7, 30)
+MAX_CONTEXT = 1024
+
+# Arbitrary input lengths would make torch.compile re-trace per shape.
+# Inputs are left-padded up to one of these fixed sizes instead, so
+# Dynamo only ever sees a handful of static shapes.
+_BUCKETS = (64, 128, 256, 512, 1024)
+
+
+# Recycled input buffers, one small LIFO pool per bucket size. Handlers
+# release their buffer once the response is built, so a steady request
+# stream stops allocating fresh arrays entirely.
+_POOL = {bucket: queue.LifoQueue(maxsize=16) for bucket in _BUCKETS}
+
+
+def _acquire_buffer(bucket):
+    try:
+        return _POOL[bucket].get_nowait()
+    except queue.Empty:
+        return np.empty(bucket, dtype=np.float32)
+
+
+def _release_buffer(price_array):
+    """Return a request buffer to its bucket's pool; drop it when the
+    pool is full or the array is not pool-sized."""
+    try:
+        _POOL[len(price_array)].put_nowait(price_array)
+    except (KeyError, queue.Full):
+        pass
+
+
+def _bucket_pad(prices):
+    """Fill a pooled float32 array at the nearest bucket size, left-padded
+    with the oldest price. TimesFM normalizes inputs, so the flat prefix
+    is effectively inert; the newest prices stay at the end."""
+    prices_tail = prices[-MAX_CONTEXT:]
+    length = len(prices_tail)
+    bucket = next(b for b in _BUCKETS if b >= length)
+    price_array = _acquire_buffer(bucket)
+    price_array[:bucket - length] = prices_tail[0]
+    # fromiter with an explicit count skips the two-pass dtype inference
+    # np.array does on Python lists.
+    price_array[bucket - length:] = np.fromiter(
+        prices_tail, dtype=np.float32, count=length
+    )
+    return price_array
+
+model = None
+batcher = None
+
+# Serializes access to the model's forward pass. The event loop keeps
+# handling HTTP concurrently; only the forecast call is exclusive.
+_INFER_LOCK = threading.Lock()
+
+MAX_BATCH = 16
+MAX_WAIT_MS = 5
+
+# Idempotent (symbol, horizon, prices) queries — common from polling
+# dashboards — are served from a short-lived cache of response dicts so
+# repeats skip inference entirely. Only the timestamp is re-stamped.
+_CACHE = TTLCache(
+    maxsize=1024, ttl=float(os.environ.get('ML_PREDICT_CACHE_TTL', '30'))
+)
+_CACHE_LOCK = threading.Lock()
+
+
+# (second, formatted string) memo for _iso_now; timestamps only need
+# second resolution, so repeated calls within the same wall-clock second
+# reuse one formatted string.
+_LAST_TIMESTAMP = (0, '')
+
+
+def _iso_now():
+    """ISO-8601 UTC timestamp via C-level strftime, cached per second."""
+    global _LAST_TIMESTAMP
+    now = int(time.time())
+    last_sec, last_str = _LAST_TIMESTAMP
+    if now != last_sec:
+        last_str = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(now))
+        _LAST_TIMESTAMP = (now, last_str)
+    return last_str
+
+
+def _cache_key(symbol, horizon, price_array, want_quantiles):
+    digest = hashlib.blake2b(price_array.tobytes(), digest_size=16).digest()
+    return (symbol, horizon, digest, want_quantiles)
+
+
+# Reduced-precision autocast dtype; set at load time when CUDA is
+# available (bf16 where supported, fp16 otherwise), None on CPU.
+_AUTOCAST_DTYPE = None
+
+# Pinned staging buffer, allocated per worker on CUDA. Inputs copied
+# through pinned pages make the model's internal host-to-device
+# transfers DMA-capable, skipping the pageable staging hop.
+_PINNED = None
+
+
+def _stage_inputs(inputs):
+    """Copy inputs into the pinned staging buffer, returning numpy views
+    of its rows. Falls back to the originals if the batch outgrows the
+    buffer (the scheduler caps batches at MAX_BATCH, so it should not)."""
+    if _PINNED is None or len(inputs) > _PINNED.shape[0]:
+        return inputs
+    staged = []
+    for i, arr in enumerate(inputs):
+        row = _PINNED[i, :len(arr)]
+        row.copy_(torch.from_numpy(arr))
+        staged.append(row.numpy())
+    return staged
+
+
+def _forecast(horizon, inputs):
+    """Run one batched forward pass. Only called by the batch scheduler.
+
+    inference_mode skips autograd bookkeeping entirely; on CUDA the pass
+    additionally runs under reduced-precision autocast from pinned input
+    memory. _INFER_LOCK serializes passes end to end, so the pinned
+    buffer only buys faster copies, not cross-request overlap.
+    """
+    with _INFER_LOCK, torch.inference_mode():
+        return _forecast_inner(horizon, _stage_inputs(inputs))
+
+
+# One pre-bound forecaster per legal horizon, built at load time. Each
+# callable is a stable dispatch target for its horizon, so the three
+# compiled-graph specializations coexist and alternating horizons never
+# churn a shared entry point.
+_FORECAST_FNS = {}
+
+
+def _make_forecaster(horizon):
+    """Close over one legal horizon, constant-folding it out of the hot
+    path; the horizon keyword never varies within the returned callable."""
+    def forecast_fixed(inputs):
+        return model.forecast(horizon=horizon, inputs=inputs)
+    return forecast_fixed
+
+
+def _forecast_inner(horizon, inputs):
+    forecast_fixed = _FORECAST_FNS[horizon]
+    if _AUTOCAST_DTYPE is not None:
+        with torch.autocast(device_type='cuda', dtype=_AUTOCAST_DTYPE):
+            return forecast_fixed(inputs)
+    return forecast_fixed(inputs)
+
+
+def load_model(share=False):
+    """Load and compile TimesFM weights.
+
+    Called once per worker process, or — with share=True — once in the
+    gunicorn master before forking, with the CPU weights moved into
+    shared memory so every worker re-attaches to a single copy instead
+    of loading and compiling its own. Only the model itself is built
+    here; per-process inference state comes from init_worker, which must
+    run after any fork.
+    """
+    global model
+    import timesfm
+
+    logger.info('Loading TimesFM model...')
+    logger.info('Inductor cache dir: %s', os.environ['TORCHINDUCTOR_CACHE_DIR'])
+    try:
+        # "reduce-overhead" (CUDA graphs) helps small-batch inference the
+        # most; fall back for timesfm builds without the argument.
+        model = timesfm.TimesFM_2p5_200M_torch.from_pretrained(
+            'google/timesfm-2.5-200m-pytorch',
+            torch_compile=True,
+            compile_mode='reduce-overhead',
+        )
+    except TypeError:
+        model = timesfm.TimesFM_2p5_200M_torch.from_pretrained(
+            'google/timesfm-2.5-200m-pytorch',
+            torch_compile=True,
+        )
+    forecast_config = timesfm.ForecastConfig(
+        max_context=MAX_CONTEXT,
+        max_horizon=256,
+        normalize_inputs=True,
+        use_continuous_quantile_head=True,
+    )
+    model.compile(forecast_config)
+    if share:
+        if torch.cuda.is_available():
+            # CUDA contexts do not survive fork; sharing is CPU-only.
+            logger.warning(
+                'ML_SHARE_MODEL requested but CUDA is available; '
+                'GPU workers must each own their model copy'
+            )
+        else:
+            target = getattr(model, 'module', model)
+            try:
+                target.share_memory()
+                logger.info('Model weights moved to shared memory')
+            except AttributeError:
+                logger.warning(
+                    'Model does not expose share_memory(); '
+                    'relying on fork copy-on-write'
+                )
+    logger.info('TimesFM model loaded')
+
+
+def init_worker():
+    """Build per-process inference state: autocast dtype, pinned buffer,
+    the pre-bound horizon forecasters and the batch scheduler, then warm
+    up. Must run in the serving process itself — the scheduler's drain
+    thread would not survive a fork, leaving every submitted future
+    unresolved.
+    """
+    global batcher
+    if torch.cuda.is_available():
+        global _AUTOCAST_DTYPE, _PINNED
+        _AUTOCAST_DTYPE = (
+            torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        )
+        _PINNED = torch.empty(
+            (MAX_BATCH, MAX_CONTEXT), dtype=torch.float32, pin_memory=True
+        )
+        logger.info('Inference autocast enabled (%s)', _AUTOCAST_DTYPE)
+    _FORECAST_FNS.update({h: _make_forecaster(h) for h in VALID_HORIZONS})
+    batcher = BatchScheduler(_forecast, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS)
+    if os.environ.get('TIMESFM_WARMUP', '1') == '1':
+        _warmup()
+        _check_reduced_precision()
+
+
+def _warmup():
+    """Run one forecast per legal horizon so Dynamo/Inductor compile each
+    horizon's graph at startup instead of on the first real request."""
+    start = time.perf_counter()
+    warmup_input = np.ones(MAX_CONTEXT, dtype=np.float32)
+    for horizon in VALID_HORIZONS:
+        _forecast(horizon, [warmup_input])
+    logger.info(
+        'Warm-up for horizons %s took %.1fs',
+        VALID_HORIZONS,
+        time.perf_counter() - start,
+    )
+
+
+def _check_reduced_precision():
+    """Sanity-check autocast output against full precision on a synthetic
+    series; reduced precision should be invisible after 2-decimal
+    rounding, so warn loudly if it is not."""
+    if _AUTOCAST_DTYPE is None:
+        return
+    series = np.linspace(90.0, 110.0, MAX_CONTEXT, dtype=np.float32)
+    with torch.inference_mode():
+        full, _ = model.forecast(horizon=7, inputs=[series])
+    reduced, _ = _forecast(7, [series])
+    full_price = float(np.asarray(full[0])[-1])
+    reduced_price = float(np.asarray(reduced[0])[-1])
+    rel_err = abs(full_price - reduced_price) / max(abs(full_price), 1e-9)
+    if rel_err > 1e-3:
+        logger.warning(
+            'Reduced-precision drift %.2e exceeds 1e-3 '
+            '(fp32=%.4f, autocast=%.4f)',
+            rel_err, full_price, reduced_price,
+        )
+
+
+def _json_response(obj, status=200):
+    """orjson-backed replacement for jsonify. OPT_SERIALIZE_NUMPY encodes
+    ndarrays directly, so responses skip the .tolist() detour."""
+    return app.response_class(
+        orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY),
+        status=status,
+        mimetype='application/json',
+    )
+
+
+def calculate_confidence(quant_row, price_change):
+    """Derive a 0-100 confidence score from the final-step quantile row.
+
+    A tight spread between the outer quantiles means the model is more
+    certain. quant_row is always either a 1-D ndarray — callers normalize
+    the shape right after the forecast — or None, which selects the
+    magnitude-based heuristic; every operation is total on those inputs.
+    """
+    if quant_row is None or not quant_row.size:
+        return int(max(40, min(90, 50 + abs(price_change) * 5)))
+    spread = float(np.abs(quant_row[-1] - quant_row[0]))
+    mean_val = float(np.abs(np.mean(quant_row)))
+    relative_spread = spread / mean_val if mean_val > 0 else 0.0
+    return int(max(40, min(95, 90 - relative_spread * 50)))
+
+
+# Per-route body-size ceilings, generous for legitimate traffic: ~256 KB
+# covers a full 1024-point history, 8 MB covers the largest batch.
+_MAX_BODY_BYTES = {
+    '/predict': 256 * 1024,
+    '/batch-predict': 8 * 1024 * 1024,
+}
+
+# Framework-enforced backstop: chunked uploads carry no Content-Length,
+# so Quart caps them while reading the body instead.
+app.config['MAX_CONTENT_LENGTH'] = max(_MAX_BODY_BYTES.values())
+
+
+@app.before_request
+async def _reject_oversize_body():
+    """Reject oversize payloads from Content-Length alone, before any
+    CPython JSON parsing work is spent on them. Bodies without a
+    Content-Length fall through to the MAX_CONTENT_LENGTH backstop."""
+    limit = _MAX_BODY_BYTES.get(request.path)
+    if limit is not None and (request.content_length or 0) > limit:
+        return _json_response({'error': 'Request body too large'}, status=413)
+
+
+def calculate_confidence_batch(last_quantiles, price_changes):
+    """Vectorized counterpart of calculate_confidence.
+
+    Takes the final-step quantiles stacked into (B, Q) and returns int32
+    scores for the whole batch in one numpy pass. price_changes is
+    accepted for signature parity with the scalar fallback but unused:
+    quantiles are always available on this path.
+    """
+    spread = np.abs(last_quantiles[:, -1] - last_quantiles[:, 0])
+    mean_val = np.abs(last_quantiles.mean(axis=-1))
+    relative_spread = np.where(
+        mean_val > 0, spread / np.maximum(mean_val, 1e-12), 0.0
+    )
+    return np.clip(90 - relative_spread * 50, 40, 95).astype(np.int32)
+
+
+@app.route('/health', methods=['GET'])
+async def health():
+    return _json_response({
+        'status': 'ok' if model is not None else 'loading',
+        'model_version': MODEL_VERSION,
+        'timestamp': _iso_now(),
+    })
+
+
+@app.route('/predict', methods=['POST'])
+async def predict():
+    data = await request.get_json()
+    if not data:
+        return _json_response({'error': 'Missing request body'}, status=400)
+
+    symbol = data.get('symbol', 'UNKNOWN')
+    prices = data.get('prices', [])
+    horizon = int(data.get('horizon', 7))
+    want_quantiles = bool(data.get('include_quantiles', True))
+
+    if horizon not in VALID_HORIZONS:
+        return _json_response(
+            {'error': f'horizon must be one of {VALID_HORIZONS}'}, status=400
+        )
+    if len(prices) < 30:
+        return _json_response({'error': 'Need at least 30 price points'}, status=400)
+    if model is None:
+        return _json_response({'error': 'Model not loaded'}, status=503)
+
+    price_array = _bucket_pad(prices)
+
+    key = _cache_key(symbol, horizon, price_array, want_quantiles)
+    with _CACHE_LOCK:
+        cached = _CACHE.get(key)
+    if cached is not None:
+        _release_buffer(price_array)
+        return _json_response(dict(cached, timestamp=_iso_now()))
+
+    # Awaiting the scheduler future keeps the event loop free to read
+    # and batch other requests while this forecast is in flight.
+    point_forecast, quantile_forecast = await asyncio.wrap_future(
+        batcher.submit(price_array, horizon)
+    )
+
+    # Post-process as ndarrays; orjson serializes them directly at the
+    # JSON boundary, so no .tolist() materialization is needed. Quantiles
+    # only feed the confidence score, so clients that pass
+    # include_quantiles=false skip their device-to-host materialization
+    # and get the magnitude-based confidence fallback instead.
+    forecast_arr = np.asarray(point_forecast, dtype=np.float32)
+    if want_quantiles:
+        quant = np.asarray(quantile_forecast, dtype=np.float32)
+        quant_row = quant[-1] if quant.ndim > 1 else quant
+    else:
+        quant_row = None
+
+    predicted_price = float(forecast_arr[-1])
+    price_change = float(
+        (forecast_arr[-1] - price_array[-1]) / price_array[-1] * 100.0
+    )
+    _release_buffer(price_array)
+
+    if price_change > 1:
+        direction = 'up'
+    elif price_change < -1:
+        direction = 'down'
+    else:
+        direction = 'neutral'
+
+    confidence = calculate_confidence(quant_row, price_change)
+
+    result = {
+        'symbol': symbol,
+        'direction': direction,
+        'confidence': confidence,
+        'predicted_change': round(price_change, 2),
+        'predicted_price': round(predicted_price, 2),
+        'forecast': np.round(forecast_arr.astype(np.float64), 2),
+        'horizon': horizon,
+        'model_version': MODEL_VERSION,
+        'timestamp': _iso_now(),
+    }
+    with _CACHE_LOCK:
+        _CACHE[key] = result
+    return _json_response(result)
+
+
+@app.route('/batch-predict', methods=['POST'])
+async def batch_predict():
+    data = await request.get_json()
+    if not data or 'requests' not in data:
+        return _json_response({'error': 'Missing requests array'}, status=400)
+    if model is None:
+        return _json_response({'error': 'Model not loaded'}, status=503)
+
+    symbols = []
+    inputs = []
+    horizons = []
+    keys = []
+    cached_results = []
+    want_quantiles = []
+    for req in data['requests']:
+        prices = req.get('prices', [])
+        horizon = int(req.get('horizon', 7))
+        if len(prices) < 30 or horizon not in VALID_HORIZONS:
+            continue
+        symbol = req.get('symbol', 'UNKNOWN')
+        wants = bool(req.get('include_quantiles', True))
+        price_array = _bucket_pad(prices)
+        key = _cache_key(symbol, horizon, price_array, wants)
+        with _CACHE_LOCK:
+            cached = _CACHE.get(key)
+        symbols.append(symbol)
+        inputs.append(price_array)
+        horizons.append(horizon)
+        keys.append(key)
+        cached_results.append(cached)
+        want_quantiles.append(wants)
+
+    if not inputs:
+        return _json_response({'predictions': []})
+
+    # Cache misses go through the same queue as /predict, so concurrent
+    # batch and single calls coalesce into shared forward passes.
+    futures = [
+        None if cached_results[i] is not None
+        else batcher.submit(inputs[i], horizons[i])
+        for i in range(len(inputs))
+    ]
+
+    now = _iso_now()
+    predictions = [None] * len(symbols)
+    misses = []
+    for i, cached in enumerate(cached_results):
+        if cached is not None:
+            predictions[i] = dict(cached, timestamp=now)
+        else:
+            misses.append(i)
+
+    if misses:
+        # Quantile rows are only materialized if some item in the batch
+        # wants quantile-based confidence.
+        any_quantiles = any(want_quantiles[i] for i in misses)
+        point_rows = []
+        quantile_rows = []
+        for i in misses:
+            point_forecast, quantile_forecast = await asyncio.wrap_future(futures[i])
+            point_rows.append(np.asarray(point_forecast, dtype=np.float32))
+            if any_quantiles:
+                quantile_rows.append(
+                    np.asarray(quantile_forecast, dtype=np.float32)
+                )
+
+        # One vectorized pass over the whole batch: stack the per-item
+        # forecasts into (B, max_horizon) and compute every scalar field
+        # with array ops; Python only reappears when zipping the dicts.
+        batch_size = len(misses)
+        miss_horizons = np.array([horizons[i] for i in misses])
+        pf = np.zeros((batch_size, int(miss_horizons.max())), dtype=np.float32)
+        for j, row in enumerate(point_rows):
+            pf[j, :len(row)] = row
+
+        # Scalar fields are derived in float64, like the single-predict
+        # path; rounding float32 directly would leak noise digits into
+        # the response (135.4499969482422 instead of 135.45).
+        last_prices = np.array([inputs[i][-1] for i in misses], dtype=np.float64)
+        predicted_prices = pf[np.arange(batch_size), miss_horizons - 1].astype(
+            np.float64
+        )
+        price_changes = (predicted_prices - last_prices) / last_prices * 100.0
+        directions = np.where(
+            price_changes > 1, 'up', np.where(price_changes < -1, 'down', 'neutral')
+        )
+        rounded = np.round(pf.astype(np.float64), 2)
+        rounded_changes = np.round(price_changes, 2)
+        rounded_prices = np.round(predicted_prices, 2)
+
+        fallback = np.clip(50 + np.abs(price_changes) * 5, 40, 90).astype(np.int32)
+        if any_quantiles:
+            last_quantiles = np.stack(
+                [row[-1] if row.ndim > 1 else row for row in quantile_rows]
+            )
+            quantile_conf = calculate_confidence_batch(last_quantiles, price_changes)
+            wants_mask = np.array([want_quantiles[i] for i in misses])
+            confidences = np.where(wants_mask, quantile_conf, fallback)
+        else:
+            confidences = fallback
+
+        with _CACHE_LOCK:
+            for j, i in enumerate(misses):
+                horizon = horizons[i]
+                prediction = {
+                    'symbol': symbols[i],
+                    'direction': str(directions[j]),
+                    'confidence': int(confidences[j]),
+                    'predicted_change': float(rounded_changes[j]),
+                    'predicted_price': float(rounded_prices[j]),
+                    'forecast': rounded[j, :horizon],
+                    'horizon': horizon,
+                    'model_version': MODEL_VERSION,
+                    'timestamp': now,
+                }
+                _CACHE[keys[i]] = prediction
+                predictions[i] = prediction
+
+    for price_array in inputs:
+        _release_buffer(price_array)
+
+    return _json_response({'predictions': predictions})
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The service is a flat script directory, not a package; make its
+# modules importable when pytest runs from the repo root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
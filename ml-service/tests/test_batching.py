@@ -0,0 +1,118 @@
+"""
+Behavior tests for BatchScheduler: result distribution, (shape, horizon)
+grouping, the max_batch cap, and exception fan-out. The scheduler is
+pure Python, so these run without torch or timesfm installed.
+"""
+
+import threading
+import time
+
+import pytest
+
+from batching import BatchScheduler
+
+
+def _echo_infer(horizon, arrays):
+    """Fake forecast: each input's row is its first value repeated
+    horizon times, so callers can verify they got their own result."""
+    points = [[a[0]] * horizon for a in arrays]
+    quantiles = [[[a[0]] * 3] * horizon for a in arrays]
+    return points, quantiles
+
+
+def _wait_all(futures, timeout=5):
+    for future in futures:
+        future.result(timeout=timeout)
+
+
+def test_each_caller_gets_its_own_row():
+    scheduler = BatchScheduler(_echo_infer, max_batch=8, max_wait_ms=20)
+    futures = [scheduler.submit([float(i)] * 64, 7) for i in range(4)]
+    _wait_all(futures)
+    for i, future in enumerate(futures):
+        point, quantile = future.result()
+        assert point == [float(i)] * 7
+        assert quantile == [[float(i)] * 3] * 7
+
+
+def test_groups_by_shape_and_horizon():
+    calls = []
+    lock = threading.Lock()
+
+    def recording_infer(horizon, arrays):
+        with lock:
+            calls.append((horizon, [len(a) for a in arrays]))
+        return _echo_infer(horizon, arrays)
+
+    # Generous max_wait so all submissions land in one drain, which the
+    # scheduler must then split into uniform (shape, horizon) groups.
+    scheduler = BatchScheduler(recording_infer, max_batch=16, max_wait_ms=200)
+    futures = [
+        scheduler.submit([1.0] * 64, 7),
+        scheduler.submit([2.0] * 64, 7),
+        scheduler.submit([3.0] * 128, 7),
+        scheduler.submit([4.0] * 64, 30),
+    ]
+    _wait_all(futures)
+
+    for horizon, lengths in calls:
+        assert len(set(lengths)) == 1, 'mixed shapes in one forward pass'
+    grouped = sorted((h, lengths[0], len(lengths)) for h, lengths in calls)
+    assert grouped == [(7, 64, 2), (7, 128, 1), (30, 64, 1)]
+
+
+def test_max_batch_caps_forward_pass_size():
+    sizes = []
+    lock = threading.Lock()
+
+    def recording_infer(horizon, arrays):
+        with lock:
+            sizes.append(len(arrays))
+        return _echo_infer(horizon, arrays)
+
+    scheduler = BatchScheduler(recording_infer, max_batch=2, max_wait_ms=200)
+    futures = [scheduler.submit([1.0] * 64, 7) for _ in range(5)]
+    _wait_all(futures)
+
+    assert sum(sizes) == 5
+    assert max(sizes) <= 2
+
+
+def test_drain_deadline_splits_spaced_submissions():
+    calls = []
+    lock = threading.Lock()
+
+    def recording_infer(horizon, arrays):
+        with lock:
+            calls.append(len(arrays))
+        return _echo_infer(horizon, arrays)
+
+    scheduler = BatchScheduler(recording_infer, max_batch=16, max_wait_ms=5)
+    first = scheduler.submit([1.0] * 64, 7)
+    first.result(timeout=5)
+    time.sleep(0.1)
+    second = scheduler.submit([2.0] * 64, 7)
+    second.result(timeout=5)
+
+    assert calls == [1, 1]
+
+
+def test_exception_fans_out_and_scheduler_survives():
+    attempts = []
+
+    def flaky_infer(horizon, arrays):
+        attempts.append(len(arrays))
+        if len(attempts) == 1:
+            raise ValueError('boom')
+        return _echo_infer(horizon, arrays)
+
+    scheduler = BatchScheduler(flaky_infer, max_batch=16, max_wait_ms=50)
+    failed = [scheduler.submit([1.0] * 64, 7), scheduler.submit([2.0] * 64, 7)]
+    for future in failed:
+        with pytest.raises(ValueError):
+            future.result(timeout=5)
+
+    # The drain loop must keep running after a failed pass.
+    ok = scheduler.submit([3.0] * 64, 7)
+    point, _ = ok.result(timeout=5)
+    assert point == [3.0] * 7
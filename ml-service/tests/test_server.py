@@ -0,0 +1,178 @@
+"""
+Tests for server.py helpers: input bucketing, scalar/batch confidence
+parity, and the request-size guards. Importing server needs the heavier
+runtime dependencies (torch for the inference wrappers), so the module
+is skipped where they are unavailable; timesfm itself is not required
+because the model is loaded lazily.
+"""
+
+import asyncio
+import json
+from concurrent.futures import Future
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+pytest.importorskip('quart')
+
+import server
+
+
+def test_bucket_pad_rounds_up_to_fixed_sizes():
+    for length, bucket in ((30, 64), (64, 64), (65, 128), (600, 1024)):
+        prices = [100.0 + i for i in range(length)]
+        arr = server._bucket_pad(prices)
+        assert arr.dtype == np.float32
+        assert len(arr) == bucket
+        # Newest prices at the end, oldest value as the left pad.
+        assert arr[-1] == pytest.approx(prices[-1])
+        np.testing.assert_allclose(arr[-length:], prices)
+        assert (arr[:bucket - length] == np.float32(prices[0])).all()
+
+
+def test_bucket_pad_caps_history_at_max_context():
+    prices = [float(i) for i in range(5000)]
+    arr = server._bucket_pad(prices)
+    assert len(arr) == server.MAX_CONTEXT
+    np.testing.assert_allclose(arr, prices[-server.MAX_CONTEXT:])
+
+
+def test_confidence_scalar_and_batch_agree():
+    rng = np.random.default_rng(42)
+    rows = 100.0 + rng.normal(0.0, 5.0, size=(64, 9))
+    rows.sort(axis=-1)
+    price_changes = rng.normal(0.0, 3.0, size=64)
+
+    batch = server.calculate_confidence_batch(rows, price_changes)
+    for j in range(len(rows)):
+        scalar = server.calculate_confidence(rows[j], float(price_changes[j]))
+        assert scalar == int(batch[j])
+
+
+def test_confidence_degenerate_quantiles():
+    # All-zero quantiles: zero mean must not divide, spread counts as 0.
+    zeros = np.zeros((1, 9))
+    assert int(server.calculate_confidence_batch(zeros, np.zeros(1))[0]) == 90
+    assert server.calculate_confidence(zeros[0], 0.0) == 90
+
+
+def test_confidence_fallback_without_quantiles():
+    assert server.calculate_confidence(None, 0.0) == 50
+    assert server.calculate_confidence(None, 4.0) == 70
+    assert server.calculate_confidence(None, 100.0) == 90
+
+
+def _post(path, body, headers=None):
+    client = server.app.test_client()
+
+    async def run():
+        return await client.post(
+            path,
+            data=body,
+            headers={'Content-Type': 'application/json', **(headers or {})},
+        )
+
+    return asyncio.run(run())
+
+
+def test_oversize_predict_body_rejected_before_parsing():
+    body = b'{"symbol": "BTC", "horizon": 7, "prices": [' \
+        + b'1.0,' * 100000 + b'1.0]}'
+    assert len(body) > server._MAX_BODY_BYTES['/predict']
+    # The test client sends no Content-Length by default; the fast path
+    # under test is the declared-length header check.
+    response = _post('/predict', body, {'Content-Length': str(len(body))})
+    assert response.status_code == 413
+
+
+def test_chunked_oversize_body_hits_framework_backstop():
+    # Without a Content-Length (chunked transfer) the per-route header
+    # check cannot fire; MAX_CONTENT_LENGTH must cap the read instead.
+    body = b'x' * (server.app.config['MAX_CONTENT_LENGTH'] + 1024)
+    response = _post('/predict', body)
+    assert response.status_code == 413
+
+
+def test_normal_body_passes_size_guard():
+    # No model is loaded in tests, so clearing the guard means reaching
+    # the 503 from the handler itself.
+    body = b'{"symbol": "BTC", "horizon": 7, "prices": [' \
+        + b'1.0,' * 40 + b'1.0]}'
+    response = _post('/predict', body)
+    assert response.status_code == 503
+
+
+class _StubBatcher:
+    """Resolves every submission immediately with float32 forecasts, the
+    dtype the real model hands back."""
+
+    def submit(self, price_array, horizon):
+        future = Future()
+        point = np.full(horizon, 135.45, dtype=np.float32)
+        quantiles = np.tile(
+            np.linspace(130.0, 140.0, 5, dtype=np.float32), (horizon, 1)
+        )
+        future.set_result((point, quantiles))
+        return future
+
+
+@pytest.fixture
+def stubbed_model(monkeypatch):
+    monkeypatch.setattr(server, 'model', object())
+    monkeypatch.setattr(server, 'batcher', _StubBatcher())
+    server._CACHE.clear()
+
+
+def _assert_two_decimal(value):
+    assert value == round(value, 2), f'float32 noise in response: {value!r}'
+
+
+def test_batch_predict_scalars_are_clean_two_decimal_floats(stubbed_model):
+    prices = [100.0 + 0.1 * i for i in range(40)]
+    body = json.dumps({
+        'requests': [
+            {'symbol': 'BTC', 'prices': prices, 'horizon': 7},
+            {'symbol': 'ETH', 'prices': [p * 1.3 for p in prices], 'horizon': 30},
+        ],
+    })
+    response = _post('/batch-predict', body)
+    assert response.status_code == 200
+
+    predictions = asyncio.run(response.get_json())['predictions']
+    assert len(predictions) == 2
+    for prediction in predictions:
+        _assert_two_decimal(prediction['predicted_price'])
+        _assert_two_decimal(prediction['predicted_change'])
+        for value in prediction['forecast']:
+            _assert_two_decimal(value)
+    assert predictions[0]['predicted_price'] == 135.45
+
+
+def test_predict_and_batch_predict_agree_on_scalars(stubbed_model):
+    prices = [100.0 + 0.1 * i for i in range(40)]
+
+    batch_response = _post('/batch-predict', json.dumps({
+        'requests': [{'symbol': 'BTC', 'prices': prices, 'horizon': 7}],
+    }))
+    batched = asyncio.run(batch_response.get_json())['predictions'][0]
+
+    # Clear the cache so both endpoints compute fresh rather than one
+    # echoing the other's cached entry.
+    server._CACHE.clear()
+    single_response = _post('/predict', json.dumps({
+        'symbol': 'BTC', 'prices': prices, 'horizon': 7,
+    }))
+    single = asyncio.run(single_response.get_json())
+
+    assert single['predicted_price'] == batched['predicted_price']
+    assert single['predicted_change'] == batched['predicted_change']
+    assert single['forecast'] == batched['forecast']
+
+
+def test_chunked_backstop_configured():
+    # Chunked uploads carry no Content-Length; the framework cap must
+    # cover the largest per-route ceiling.
+    assert server.app.config['MAX_CONTENT_LENGTH'] == max(
+        server._MAX_BODY_BYTES.values()
+    )